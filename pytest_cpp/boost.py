@@ -1,10 +1,24 @@
 import os
+import re
 import subprocess
-import tempfile
-from xml.etree import ElementTree
-import io
-import shutil
+
 from pytest_cpp.error import CppTestFailure
+from pytest_cpp.helpers import (ElementTree, XML_PARSER_OPTIONS,
+                                get_help_output, get_temp_filename)
+
+# log elements reported as failures
+_FAILURE_TAGS = frozenset(['Exception', 'Error', 'FatalError'])
+
+# maps executable to its label, filled by _exe_label()
+_EXE_LABELS = {}
+
+# fatal error written by older Boost versions before the <TestLog> element,
+# see BoostTestFacade._parse_log(); file names with entity or character
+# references are left to the XML parser
+_FATAL_ERROR = re.compile(
+    br'<FatalError file="(?P<file>[^"&]*)" line="(?P<line>\d+)">'
+    br'<!\[CDATA\[(?P<text>(?:(?!\]\]>).)*)\]\]></FatalError>$',
+    re.DOTALL)
 
 
 class BoostTestFacade(object):
@@ -14,70 +28,80 @@ class BoostTestFacade(object):
 
     @classmethod
     def is_test_suite(cls, executable):
-        try:
-            output = subprocess.check_output([executable, '--help'],
-                                             stderr=subprocess.STDOUT,
-                                             universal_newlines=True)
-        except (subprocess.CalledProcessError, OSError):
+        output = get_help_output(executable)
+        if output is None:
             return False
-        else:
-            return '--output_format' in output and 'log_format' in output
+        return '--output_format' in output and 'log_format' in output
 
     def list_tests(self, executable):
         # unfortunately boost doesn't provide us with a way to list the tests
         # inside the executable, so the test_id is a dummy placeholder :(
-        return [os.path.basename(os.path.splitext(executable)[0])]
+        return [_exe_label(executable)]
 
     def run_test(self, executable, test_id):
 
         def read_file(name):
+            # raw bytes, handed as they are to the XML parser
             try:
-                with io.open(name) as f:
-                    return f.read()
-            except IOError:
+                fd = os.open(name, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            except OSError:
                 return None
-
-        temp_dir = tempfile.mkdtemp()
-        log_xml = os.path.join(temp_dir, 'log.xml')
-        report_xml = os.path.join(temp_dir, 'report.xml')
+            try:
+                return os.read(fd, os.fstat(fd).st_size)
+            finally:
+                os.close(fd)
+
+        # log and report can't be sent to stdout/stderr and read from pipes:
+        # the tests themselves (and their fixtures) are free to write there,
+        # which would end up mixed with the XML; the temporary files are
+        # kept in memory when possible instead.
+        log_xml = get_temp_filename('log_', '.xml')
+        report_xml = get_temp_filename('report_', '.xml')
         args = [
             executable,
             '--output_format=XML',
             '--log_sink=%s' % log_xml,
             '--report_sink=%s' % report_xml,
+            # only failures are of interest: keep the files small; the
+            # report is then only written on setup or internal errors
+            '--log_level=error',
+            '--report_level=no',
         ]
-        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        stdout, _ = p.communicate()
+        try:
+            p = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+            stdout, _ = p.communicate()
 
-        log = read_file(log_xml)
-        report = read_file(report_xml)
+            log = read_file(log_xml)
+            report = read_file(report_xml)
+        finally:
+            for name in (log_xml, report_xml):
+                if os.path.exists(name):
+                    os.remove(name)
 
         if p.returncode not in (0, 200, 201):
             msg = ('Internal Error: calling {executable} '
                    'for test {test_id} failed (returncode={returncode}):\n'
                    'output:{stdout}\n'
-                   'log:{log}\n'
-                   'report:{report}')
+                   'log:{log}')
             failure = BoostTestFailure(
                 '<no source file>',
                 linenum=0,
                 contents=msg.format(executable=executable,
                                     test_id=test_id,
                                     stdout=stdout,
-                                    log=log,
-                                    report=report,
+                                    log=_decode(log),
                                     returncode=p.returncode))
             return [failure]
 
         if report is not None and (
-                report.startswith('Boost.Test framework internal error: ') or
-                report.startswith('Test setup error: ')):
+                report.startswith(b'Boost.Test framework internal error: ') or
+                report.startswith(b'Test setup error: ')):
             # boost.test doesn't do XML output on fatal-enough errors.
-            failure = BoostTestFailure('unknown location', 0, report)
+            failure = BoostTestFailure('unknown location', 0, _decode(report))
             return [failure]
 
         results = self._parse_log(log=log)
-        shutil.rmtree(temp_dir)
         if results:
             return results
 
@@ -85,42 +109,83 @@ class BoostTestFacade(object):
         """
         Parse the "log" section produced by BoostTest.
 
-        This is always a XML file, and from this we produce most of the
-        failures possible when running BoostTest.
+        This is always a XML file (given as bytes), and from this we
+        produce most of the failures possible when running BoostTest.
         """
         # Fatal errors apparently generate invalid xml in the form:
         # <FatalError>...</FatalError><TestLog>...</TestLog>
         # so we have to manually split it into two xmls if that's the case.
-        parsed_elements = []
-        if log.startswith('<FatalError'):
-            fatal, log = log.split('</FatalError>')
-            fatal += '</FatalError>'  # put it back, removed by split()
-            fatal_root = ElementTree.fromstring(fatal)
-            fatal_root.text = 'Fatal Error: %s' % fatal_root.text
-            parsed_elements.append(fatal_root)
-
-        log_root = ElementTree.fromstring(log)
-        parsed_elements.extend(log_root.findall('Exception'))
-        parsed_elements.extend(log_root.findall('Error'))
-        parsed_elements.extend(log_root.findall('FatalError'))
-
         result = []
-        for elem in parsed_elements:
-            filename = elem.attrib['file']
-            linenum = int(elem.attrib['line'])
-            result.append(BoostTestFailure(filename, linenum, elem.text))
+        if log.startswith(b'<FatalError'):
+            end = log.index(b'</FatalError>') + len(b'</FatalError>')
+            result.append(self._parse_fatal_error(log[:end]))
+            log = log[end:]
+
+        parser = ElementTree.XMLParser(**XML_PARSER_OPTIONS)
+        log_root = ElementTree.fromstring(log, parser)
+        for elem in log_root.iter():
+            if elem.tag in _FAILURE_TAGS:
+                filename = elem.get('file')
+                linenum = int(elem.get('line'))
+                result.append(BoostTestFailure(filename, linenum, elem.text))
         return result
 
+    def _parse_fatal_error(self, fatal):
+        """
+        Parse a single <FatalError> element, avoiding a full XML parse in
+        the common case of its text being a single CDATA section.
+        """
+        match = _FATAL_ERROR.match(fatal)
+        if match is not None:
+            filename = match.group('file').decode('utf-8')
+            linenum = int(match.group('line'))
+            text = match.group('text').decode('utf-8', 'replace')
+        else:
+            parser = ElementTree.XMLParser(**XML_PARSER_OPTIONS)
+            fatal_root = ElementTree.fromstring(fatal, parser)
+            filename = fatal_root.get('file')
+            linenum = int(fatal_root.get('line'))
+            text = fatal_root.text
+        return BoostTestFailure(filename, linenum, 'Fatal Error: %s' % text)
+
+
+def _exe_label(executable):
+    """
+    Returns the executable's name without directory and extension, which is
+    used as the id of its single test.
+    """
+    try:
+        return _EXE_LABELS[executable]
+    except KeyError:
+        label = os.path.basename(os.path.splitext(executable)[0])
+        _EXE_LABELS[executable] = label
+        return label
+
+
+def _decode(data):
+    """
+    Decodes the contents of a log or report file for display.
+    """
+    if data is None:
+        return None
+    return data.decode('utf-8', 'replace')
+
 
 class BoostTestFailure(CppTestFailure):
+    markup = ('red', 'bold')
+
     def __init__(self, filename, linenum, contents):
         self.filename = filename
         self.linenum = linenum
-        self.lines = contents.splitlines()
+        # only split into lines if the failure is actually displayed
+        self._contents = contents
+        self._lines = None
 
     def get_lines(self):
-        m = ('red', 'bold')
-        return [(x, m) for x in self.lines]
+        if self._lines is None:
+            self._lines = self._contents.splitlines()
+        m = self.markup
+        return [(x, m) for x in self._lines]
 
     def get_file_reference(self):
         return self.filename, self.linenum
@@ -1,10 +1,16 @@
 import os
 import subprocess
-import tempfile
-from xml.etree import ElementTree
+from collections import OrderedDict, deque
 
 import pytest
 from pytest_cpp.error import CppTestFailure
+from pytest_cpp.helpers import (ElementTree, XML_PARSER_OPTIONS,
+                                get_help_output, get_temp_filename)
+
+
+# maximum length of the --gtest_filter argument used to execute tests in
+# batch, well below the limits of the command line on every system
+_MAX_FILTER_LENGTH = 16 * 1024
 
 
 class GoogleTestFacade(object):
@@ -12,16 +18,17 @@ class GoogleTestFacade(object):
     Facade for GoogleTests.
     """
 
+    def __init__(self):
+        # maps executable to the results of the tests executed in
+        # advance by run_tests(), as returned by _parse_xml()
+        self._results = {}
+
     @classmethod
     def is_test_suite(cls, executable):
-        try:
-            output = subprocess.check_output([executable, '--help'],
-                                             stderr=subprocess.STDOUT,
-                                             universal_newlines=True)
-        except (subprocess.CalledProcessError, OSError):
+        output = get_help_output(executable)
+        if output is None:
             return False
-        else:
-            return '--gtest_list_tests' in output
+        return '--gtest_list_tests' in output
 
     def list_tests(self, executable):
         """
@@ -37,83 +44,200 @@ class GoogleTestFacade(object):
                                          stderr=subprocess.STDOUT,
                                          universal_newlines=True)
 
-        def strip_comment(x):
-            comment_start = x.find('#')
-            if comment_start != -1:
-                x = x[:comment_start]
-            return x
-
         test_suite = None
         result = []
         for line in output.splitlines():
-            has_indent = line.startswith(' ')
-            if not has_indent and '.' in line:
-                test_suite = strip_comment(line).strip()
-            elif has_indent:
-                result.append(test_suite + strip_comment(line).strip())
+            name = line.partition('#')[0].strip()
+            if line.startswith(' '):
+                result.append(test_suite + name)
+            elif '.' in line:
+                test_suite = name
         return result
 
-    def run_test(self, executable, test_id):
-        xml_filename = self._get_temp_xml_filename()
-        args = [
-            executable,
-            '--gtest_filter=' + test_id,
-            '--gtest_output=xml:%s' % xml_filename,
-        ]
+    def run_tests(self, executable, test_ids=None, jobs=1):
+        """
+        Executes the given tests in batch, keeping their results so the
+        following calls to run_test() for each of them don't need to spawn
+        the executable again. If test_ids is None all the tests of the
+        executable are executed.
+
+        With jobs > 1 the tests are split into that many shards, each
+        executed concurrently by its own call to the executable.
+
+        If the executable fails unexpectedly (for example crashing in the
+        middle of a test) the results of that call are not kept, so
+        run_test() executes each of its tests on its own and reports the
+        failure for the offending test only.
+        """
+        if test_ids is None:
+            # no filter at all, using google-test's own sharding instead
+            calls = [([], self._get_shard_env(shard, jobs))
+                     for shard in range(jobs)] if jobs > 1 else [([], None)]
+        else:
+            jobs = max(min(jobs, len(test_ids)), 1)
+            calls = [(['--gtest_filter=' + test_filter], None)
+                     for test_filter in _split_filters(test_ids, jobs)]
+
+        results = self._results.setdefault(executable, {})
+        processes = deque()
+        # the output is not needed: if something goes wrong, run_test()
+        # executes each test again, capturing its output for the report
+        with open(os.devnull, 'wb') as devnull:
+            try:
+                for args, env in calls:
+                    if len(processes) == jobs:
+                        results.update(
+                            self._wait_results(*processes.popleft()))
+                    xml_filename = self._get_temp_xml_filename()
+                    args = [executable] + args + [
+                        '--gtest_output=xml:%s' % xml_filename,
+                    ]
+                    try:
+                        p = subprocess.Popen(args, stdout=devnull,
+                                             stderr=devnull, env=env)
+                    except OSError:
+                        # the command line may still be too long for the
+                        # system: run_test() executes the remaining tests
+                        # on their own
+                        break
+                    processes.append((p, xml_filename))
+
+                while processes:
+                    results.update(self._wait_results(*processes.popleft()))
+            finally:
+                # only left if something went wrong: don't leave processes
+                # running behind the exception
+                for p, xml_filename in processes:
+                    if p.poll() is None:
+                        p.kill()
+                    p.wait()
+                    if os.path.exists(xml_filename):
+                        os.remove(xml_filename)
+
+    def _get_shard_env(self, shard, jobs):
+        env = dict(os.environ)
+        env['GTEST_TOTAL_SHARDS'] = str(jobs)
+        env['GTEST_SHARD_INDEX'] = str(shard)
+        return env
+
+    def _wait_results(self, process, xml_filename):
+        """
+        Waits for a call to the executable started by run_tests(), returning
+        its results, or an empty dict if it failed unexpectedly.
+        """
         try:
-            subprocess.check_output(args,
-                                    stderr=subprocess.STDOUT,
-                                    universal_newlines=True)
-        except subprocess.CalledProcessError as e:
-            if e.returncode != 1:
-                msg = ('Internal Error: calling {executable} '
-                       'for test {test_id} failed (returncode={returncode}):\n'
-                       '{output}')
+            if process.wait() not in (0, 1):
+                return {}
+            try:
+                return self._parse_xml(xml_filename)
+            except (EnvironmentError, SyntaxError):
+                # a test calling exit() ends the executable before it writes
+                # the XML file (ParseError and lxml's XMLSyntaxError both
+                # derive from SyntaxError)
+                return {}
+        finally:
+            if os.path.exists(xml_filename):
+                os.remove(xml_filename)
+
+    def run_test(self, executable, test_id):
+        # results obtained by run_tests() are used only once, so running
+        # a test again executes it again
+        result = self._results.get(executable, {}).pop(test_id, None)
+        if result is None:
+            xml_filename = self._get_temp_xml_filename()
+            args = [
+                executable,
+                '--gtest_filter=' + test_id,
+                '--gtest_output=xml:%s' % xml_filename,
+            ]
+            try:
+                subprocess.check_output(args,
+                                        stderr=subprocess.STDOUT,
+                                        universal_newlines=True)
+            except subprocess.CalledProcessError as e:
+                if e.returncode != 1:
+                    msg = ('Internal Error: calling {executable} '
+                           'for test {test_id} failed '
+                           '(returncode={returncode}):\n'
+                           '{output}')
+                    failure = GoogleTestFailure(
+                        msg.format(executable=executable, test_id=test_id,
+                                   output=e.output,
+                                   returncode=e.returncode))
+                    return [failure]
+
+            results = self._parse_xml(xml_filename)
+            os.remove(xml_filename)
+            result = results.get(test_id)
+            if result is None:
+                msg = ('Internal Error: could not find test '
+                       '{test_id} in results:\n{results}')
                 failure = GoogleTestFailure(
-                    msg.format(executable=executable, test_id=test_id,
-                               output=e.output,
-                               returncode=e.returncode))
+                    msg.format(test_id=test_id, results='\n'.join(results)))
                 return [failure]
 
-        results = self._parse_xml(xml_filename)
-        os.remove(xml_filename)
-        for (executed_test_id, failures, skipped) in results:
-            if executed_test_id == test_id:
-                if failures:
-                    return [GoogleTestFailure(x) for x in failures]
-                elif skipped:
-                    pytest.skip()
-                else:
-                    return None
-
-        msg = ('Internal Error: could not find test '
-               '{test_id} in results:\n{results}')
-        results_list = '\n'.join(x for (x, f) in results)
-        failure = GoogleTestFailure(
-            msg.format(test_id=test_id, results=results_list))
-        return [failure]
+        failures, skipped = result
+        if failures:
+            return [GoogleTestFailure(x) for x in failures]
+        elif skipped:
+            pytest.skip()
+        else:
+            return None
 
     def _get_temp_xml_filename(self):
-        return tempfile.mktemp()
+        return get_temp_filename('gtest_', '.xml')
 
     def _parse_xml(self, xml_filename):
-        root = ElementTree.parse(xml_filename)
-        result = []
-        for test_suite in root.findall('testsuite'):
-            test_suite_name = test_suite.attrib['name']
-            for test_case in test_suite.findall('testcase'):
-                test_name = test_case.attrib['name']
-                failures = []
-                failure_elements = test_case.findall('failure')
-                for failure_elem in failure_elements:
-                    failures.append(failure_elem.text)
-                skipped = test_case.attrib['status'] == 'notrun'
-                result.append(
-                    (test_suite_name + '.' + test_name, failures, skipped))
+        """
+        Parses the XML file produced by google-test, streaming through it
+        so only one test case at a time is kept in memory.
+
+        Returns a dict mapping each test id to a (failures, skipped) tuple.
+        """
+        result = OrderedDict()
+        test_suite_names = []
+        events = ElementTree.iterparse(xml_filename, events=('start', 'end'),
+                                       **XML_PARSER_OPTIONS)
+        for event, elem in events:
+            if event == 'start':
+                if elem.tag == 'testsuite':
+                    test_suite_names.append(elem.get('name'))
+            elif elem.tag == 'testcase':
+                test_name = elem.get('name')
+                failures = [child.text for child in elem
+                            if child.tag == 'failure']
+                skipped = elem.get('status') == 'notrun'
+                test_id = test_suite_names[-1] + '.' + test_name
+                result[test_id] = (failures, skipped)
+                elem.clear()
+            elif elem.tag == 'testsuite':
+                test_suite_names.pop()
+                elem.clear()
 
         return result
 
 
+def _split_filters(test_ids, jobs):
+    """
+    Splits the given test ids into one --gtest_filter value per shard, further
+    splitting each shard so no value is longer than _MAX_FILTER_LENGTH.
+    """
+    filters = []
+    for shard in range(jobs):
+        chunk = []
+        length = 0
+        for test_id in test_ids[shard::jobs]:
+            if chunk and length + len(test_id) > _MAX_FILTER_LENGTH:
+                filters.append(':'.join(chunk))
+                chunk = []
+                length = 0
+            chunk.append(test_id)
+            length += len(test_id) + 1
+        if chunk:
+            filters.append(':'.join(chunk))
+    return filters
+
+
 class GoogleTestFailure(CppTestFailure):
     def __init__(self, contents):
         self.lines = contents.splitlines()
@@ -0,0 +1,72 @@
+import atexit
+import os
+import shutil
+import subprocess
+import tempfile
+import uuid
+
+try:
+    from lxml import etree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+    XML_PARSER_OPTIONS = {}
+else:
+    # C-backed parser, considerably faster on large logs
+    XML_PARSER_OPTIONS = dict(huge_tree=True, remove_blank_text=True)
+
+# the result files written by the executables are read back and removed right
+# after each run: use a memory backed file system when available (None means
+# the default temporary directory).
+if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+    TEMP_DIR = '/dev/shm'
+else:
+    TEMP_DIR = None
+
+# directory shared by all result files of the session, see get_temp_filename()
+_session_temp_dir = None
+
+
+def get_temp_filename(prefix, suffix):
+    """
+    Returns a unique file name for the results of an executable, inside a
+    directory created once per session under TEMP_DIR and removed at exit.
+    """
+    global _session_temp_dir
+    if _session_temp_dir is None:
+        _session_temp_dir = tempfile.mkdtemp(prefix='pytest_cpp_',
+                                             dir=TEMP_DIR)
+        atexit.register(shutil.rmtree, _session_temp_dir, ignore_errors=True)
+    name = '%s%s%s' % (prefix, uuid.uuid4().hex, suffix)
+    return os.path.join(_session_temp_dir, name)
+
+
+# maps (executable, mtime) to the output of "executable --help", or None if
+# the executable could not be called; filled by get_help_output().
+_HELP_CACHE = {}
+
+
+def get_help_output(executable):
+    """
+    Returns the output of "executable --help", calling the executable
+    only once per session unless it changes on disk in the meantime, so
+    all facades can check if they support an executable with a single call.
+
+    Returns None if the executable can't be called.
+    """
+    try:
+        mtime = os.stat(executable).st_mtime
+    except OSError:
+        return None
+    key = (executable, mtime)
+    try:
+        return _HELP_CACHE[key]
+    except KeyError:
+        pass
+    try:
+        output = subprocess.check_output([executable, '--help'],
+                                         stderr=subprocess.STDOUT,
+                                         universal_newlines=True)
+    except (subprocess.CalledProcessError, OSError):
+        output = None
+    _HELP_CACHE[key] = output
+    return output
@@ -1,4 +1,5 @@
 import fnmatch
+import multiprocessing
 import os
 import stat
 import pytest
@@ -36,17 +37,68 @@ def pytest_addoption(parser):
     parser.addini("cpp_files", type="args",
         default=DEFAULT_MASKS,
         help="glob-style file patterns for C++ test module discovery")
+    parser.addini("cpp_jobs",
+        default='1',
+        help="number of processes used to execute the tests of each C++ "
+             "executable, or 'auto' to use all but two of the CPUs")
+
+
+def pytest_configure(config):
+    # validated once here so a wrong value is reported as a usage error
+    # instead of failing the setup of every executable
+    config._cpp_jobs = get_jobs(config)
+
+
+def get_jobs(config):
+    jobs = config.getini('cpp_jobs')
+    if jobs == 'auto':
+        return max(multiprocessing.cpu_count() - 2, 1)
+    try:
+        value = int(jobs)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise pytest.UsageError(
+            'cpp_jobs must be a positive number or "auto", got %r' % jobs)
+    return value
 
 
 class CppFile(pytest.File):
     def __init__(self, path, parent, facade):
         pytest.File.__init__(self, path, parent)
         self.facade = facade
+        # ids of all the tests collected from the executable
+        self._test_ids = []
+        # the file is set up again each time its items are resumed after
+        # items from other files (with --ff, for example): run_tests() is
+        # only called the first time
+        self._tests_run = False
 
     def collect(self):
-        for test_id in self.facade.list_tests(str(self.fspath)):
+        self._test_ids = self.facade.list_tests(str(self.fspath))
+        for test_id in self._test_ids:
             yield CppItem(test_id, self, self.facade)
 
+    def setup(self):
+        # when the facade supports it, execute all the tests from this file
+        # which are about to run with a single call to the executable;
+        # xdist workers only run part of the collected items, so in that
+        # case each test is executed on its own
+        run_tests = getattr(self.facade, 'run_tests', None)
+        if run_tests is None or self._tests_run or \
+                hasattr(self.config, 'slaveinput') or \
+                hasattr(self.config, 'workerinput'):
+            return
+        self._tests_run = True
+        test_ids = [item.name for item in self.session.items
+                    if item.parent is self]
+        if len(test_ids) > 1:
+            # no need to list the tests (possibly exceeding the limits of
+            # the command line) if all of them are going to run
+            if len(test_ids) == len(self._test_ids):
+                test_ids = None
+            run_tests(str(self.fspath), test_ids, self.config._cpp_jobs)
+
 
 class CppItem(pytest.Item):
     def __init__(self, name, collector, facade):
@@ -1,5 +1,7 @@
+import os
 import pytest
 import subprocess
+import sys
 from pytest_cpp import error
 from pytest_cpp.boost import BoostTestFacade
 from pytest_cpp.error import CppTestFailure, CppFailureRepr
@@ -60,6 +62,16 @@ def test_is_test_suite(facade, name, other_name, exes, tmpdir):
     assert not facade.is_test_suite(str(tmpdir.join('foo.txt')))
 
 
+@pytest.mark.parametrize('name', ['gtest', 'boost_success'])
+def test_is_test_suite_probes_once(name, exes, mocker):
+    exe = exes.get(name)
+    spy = mocker.spy(subprocess, 'check_output')
+    for facade in (GoogleTestFacade, BoostTestFacade):
+        facade.is_test_suite(exe)
+        facade.is_test_suite(exe)
+    assert spy.call_count == 1
+
+
 @pytest.mark.parametrize('facade, name, test_id', [
     (GoogleTestFacade(), 'gtest', 'FooTest.test_success'),
     (BoostTestFacade(), 'boost_success', '<unused>'),
@@ -130,6 +142,33 @@ def test_boost_fatal_error(exes):
     assert fail1.get_file_reference() == ("boost_fatal_error.cpp", 8)
 
 
+@pytest.mark.parametrize('file_attr, contents, expected_file, expected', [
+    (b'boost_fatal_error.cpp',
+     b'<![CDATA[critical check 2 * 3 == 5 failed]]>',
+     'boost_fatal_error.cpp',
+     'critical check 2 * 3 == 5 failed'),
+    (b'boost_fatal_error.cpp',
+     b'<![CDATA[check a[b[0]]]]><![CDATA[> 1 failed]]>',
+     'boost_fatal_error.cpp',
+     'check a[b[0]]> 1 failed'),
+    (b'it&apos;s_&#34;fatal&quot;.cpp',
+     b'<![CDATA[critical check 2 * 3 == 5 failed]]>',
+     'it\'s_"fatal".cpp',
+     'critical check 2 * 3 == 5 failed'),
+])
+def test_boost_parse_fatal_error_log(file_attr, contents, expected_file,
+                                     expected):
+    """
+    Older Boost versions produce the fatal error outside of <TestLog>.
+    """
+    log = (b'<FatalError file="' + file_attr + b'" line="8">' +
+           contents + b'</FatalError><TestLog></TestLog>')
+    fail1, = BoostTestFacade()._parse_log(log)
+    colors = ('red', 'bold')
+    assert fail1.get_lines() == [('Fatal Error: ' + expected, colors)]
+    assert fail1.get_file_reference() == (expected_file, 8)
+
+
 def test_boost_error(exes):
     facade = BoostTestFacade()
     failures = facade.run_test(exes.get('boost_error'), '<unused>')
@@ -158,6 +197,18 @@ def test_boost_fixture_setup_error(exes):
     assert fail1.get_file_reference() == ("unknown location", 0)
 
 
+def test_google_parse_xml():
+    xml_filename = os.path.join(os.path.dirname(__file__), 'gtest.xml')
+    results = GoogleTestFacade()._parse_xml(xml_filename)
+    assert [(test_id, len(failures), skipped)
+            for (test_id, (failures, skipped)) in results.items()] == [
+        ('FooTest.test_success', 0, False),
+        ('FooTest.test_failure', 1, False),
+        ('FooTest.test_error', 1, False),
+        ('FooTest.DISABLED_test_disabled', 0, True),
+    ]
+
+
 def test_google_run(testdir, exes):
     result = testdir.inline_run('-v', exes.get('gtest', 'test_gtest'))
     assert_outcomes(result, [
@@ -167,6 +218,247 @@ def test_google_run(testdir, exes):
         ('FooTest.DISABLED_test_disabled', 'skipped'),
     ])
 
+
+def get_gtest_runs(popen_mock):
+    """
+    Returns the calls to Popen which executed tests (as opposed to listing
+    them), as (args, kwargs) tuples.
+    """
+    return [(call[0][0], call[1]) for call in popen_mock.call_args_list
+            if any(x.startswith('--gtest_output=') for x in call[0][0])]
+
+
+def get_gtest_filters(popen_mock):
+    filters = []
+    for args, _ in get_gtest_runs(popen_mock):
+        filters.extend(x for x in args if x.startswith('--gtest_filter='))
+    return filters
+
+
+def test_google_run_executes_tests_in_batch(testdir, exes, mocker):
+    spy = mocker.patch.object(subprocess, 'Popen', wraps=subprocess.Popen)
+    result = testdir.inline_run('-v', exes.get('gtest', 'test_gtest'),
+                                '-k', 'not test_error')
+    assert_outcomes(result, [
+        ('FooTest.test_success', 'passed'),
+        ('FooTest.test_failure', 'failed'),
+        ('FooTest.DISABLED_test_disabled', 'skipped'),
+    ])
+    assert get_gtest_filters(spy) == [
+        '--gtest_filter=FooTest.test_success:FooTest.test_failure:'
+        'FooTest.DISABLED_test_disabled',
+    ]
+
+
+def test_google_run_all_tests_without_filter(testdir, exes, mocker):
+    spy = mocker.patch.object(subprocess, 'Popen', wraps=subprocess.Popen)
+    result = testdir.inline_run('-v', exes.get('gtest', 'test_gtest'))
+    assert_outcomes(result, [
+        ('FooTest.test_success', 'passed'),
+        ('FooTest.test_failure', 'failed'),
+        ('FooTest.test_error', 'failed'),
+        ('FooTest.DISABLED_test_disabled', 'skipped'),
+    ])
+    assert len(get_gtest_runs(spy)) == 1
+    assert get_gtest_filters(spy) == []
+
+
+@pytest.mark.parametrize('jobs, expected_filters', [
+    ('2', [
+        '--gtest_filter=FooTest.test_success:FooTest.DISABLED_test_disabled',
+        '--gtest_filter=FooTest.test_failure',
+    ]),
+    ('10', [
+        '--gtest_filter=FooTest.test_success',
+        '--gtest_filter=FooTest.test_failure',
+        '--gtest_filter=FooTest.DISABLED_test_disabled',
+    ]),
+])
+def test_google_run_jobs(testdir, exes, mocker, jobs, expected_filters):
+    testdir.makeini('''
+        [pytest]
+        cpp_jobs = %s
+    ''' % jobs)
+    spy = mocker.patch.object(subprocess, 'Popen', wraps=subprocess.Popen)
+    result = testdir.inline_run('-v', exes.get('gtest', 'test_gtest'),
+                                '-k', 'not test_error')
+    assert_outcomes(result, [
+        ('FooTest.test_success', 'passed'),
+        ('FooTest.test_failure', 'failed'),
+        ('FooTest.DISABLED_test_disabled', 'skipped'),
+    ])
+    assert get_gtest_filters(spy) == expected_filters
+
+
+@pytest.mark.parametrize('jobs', ['many', '0', '-1'])
+def test_invalid_jobs(testdir, exes, jobs):
+    testdir.makeini('''
+        [pytest]
+        cpp_jobs = %s
+    ''' % jobs)
+    exes.get('gtest', 'test_gtest')
+    result = testdir.runpytest()
+    assert result.ret != 0
+    result.stderr.fnmatch_lines(
+        ["*cpp_jobs must be a positive number or \"auto\", got '%s'*" % jobs])
+    assert 'FooTest' not in result.stdout.str()
+
+
+def test_google_run_tests_once_per_file(testdir, exes, mocker):
+    """
+    Executables are set up again each time their items are resumed after
+    items from other executables, but their tests are run in batch only once.
+    """
+    exes.get('gtest', 'test_gtest')
+    exes.get('gtest', 'test_gtest2')
+    testdir.inline_run()
+    spy = mocker.patch.object(subprocess, 'Popen', wraps=subprocess.Popen)
+    result = testdir.inline_run('-v', '--ff')
+    result.assertoutcome(passed=2, failed=4, skipped=2)
+    executables = [os.path.basename(args[0])
+                   for args, _ in get_gtest_runs(spy)]
+    assert sorted(executables) == [exes.exe_name('test_gtest'),
+                                   exes.exe_name('test_gtest2')]
+
+
+def test_google_run_jobs_all_tests(testdir, exes, mocker):
+    testdir.makeini('''
+        [pytest]
+        cpp_jobs = 2
+    ''')
+    spy = mocker.patch.object(subprocess, 'Popen', wraps=subprocess.Popen)
+    result = testdir.inline_run('-v', exes.get('gtest', 'test_gtest'))
+    assert_outcomes(result, [
+        ('FooTest.test_success', 'passed'),
+        ('FooTest.test_failure', 'failed'),
+        ('FooTest.test_error', 'failed'),
+        ('FooTest.DISABLED_test_disabled', 'skipped'),
+    ])
+    assert get_gtest_filters(spy) == []
+    shards = [(kwargs['env']['GTEST_TOTAL_SHARDS'],
+               kwargs['env']['GTEST_SHARD_INDEX'])
+              for _, kwargs in get_gtest_runs(spy)]
+    assert shards == [('2', '0'), ('2', '1')]
+
+
+def test_google_run_long_filter(testdir, exes, mocker):
+    mocker.patch('pytest_cpp.google._MAX_FILTER_LENGTH', 45)
+    spy = mocker.patch.object(subprocess, 'Popen', wraps=subprocess.Popen)
+    result = testdir.inline_run('-v', exes.get('gtest', 'test_gtest'),
+                                '-k', 'not test_error')
+    assert_outcomes(result, [
+        ('FooTest.test_success', 'passed'),
+        ('FooTest.test_failure', 'failed'),
+        ('FooTest.DISABLED_test_disabled', 'skipped'),
+    ])
+    assert get_gtest_filters(spy) == [
+        '--gtest_filter=FooTest.test_success:FooTest.test_failure',
+        '--gtest_filter=FooTest.DISABLED_test_disabled',
+    ]
+
+
+def test_google_run_batch_spawn_error(testdir, exes, mocker):
+    """
+    If the executable can't be spawned to run tests in batch (for example
+    because the command line is too long) each test is executed on its own.
+    """
+    popen = subprocess.Popen
+
+    def fail_on_batch(args, **kwargs):
+        if ':' in args[1]:
+            raise OSError(7, 'Argument list too long')
+        return popen(args, **kwargs)
+
+    mocked = mocker.patch.object(subprocess, 'Popen',
+                                 side_effect=fail_on_batch)
+    result = testdir.inline_run('-v', exes.get('gtest', 'test_gtest'),
+                                '-k', 'not test_error')
+    assert_outcomes(result, [
+        ('FooTest.test_success', 'passed'),
+        ('FooTest.test_failure', 'failed'),
+        ('FooTest.DISABLED_test_disabled', 'skipped'),
+    ])
+    assert len(get_gtest_filters(mocked)) == 4
+
+
+def test_google_run_batch_crash(testdir, exes, mocker):
+    """
+    If the executable crashes while running tests in batch, each test
+    is executed again on its own.
+    """
+    popen = subprocess.Popen
+
+    def crash_on_batch(args, **kwargs):
+        if args[1].startswith('--gtest_output='):
+            args = [sys.executable, '-c', 'import os; os.abort()']
+        return popen(args, **kwargs)
+
+    mocked = mocker.patch.object(subprocess, 'Popen',
+                                 side_effect=crash_on_batch)
+    result = testdir.inline_run('-v', exes.get('gtest', 'test_gtest'))
+    assert_outcomes(result, [
+        ('FooTest.test_success', 'passed'),
+        ('FooTest.test_failure', 'failed'),
+        ('FooTest.test_error', 'failed'),
+        ('FooTest.DISABLED_test_disabled', 'skipped'),
+    ])
+    assert len(get_gtest_runs(mocked)) == 5
+    assert len(get_gtest_filters(mocked)) == 4
+
+
+@pytest.mark.parametrize('batch_code', [
+    'pass',
+    'import sys; open(sys.argv[1].split(":", 1)[1], "w").write("<testsuites>")',
+])
+def test_google_run_batch_without_xml(testdir, exes, mocker, batch_code):
+    """
+    If the executable exits normally while running tests in batch without
+    writing a valid XML file (for example a test calling exit(0)), each test
+    is executed again on its own.
+    """
+    popen = subprocess.Popen
+
+    def exit_on_batch(args, **kwargs):
+        if args[1].startswith('--gtest_output='):
+            args = [sys.executable, '-c', batch_code, args[1]]
+        return popen(args, **kwargs)
+
+    mocked = mocker.patch.object(subprocess, 'Popen',
+                                 side_effect=exit_on_batch)
+    result = testdir.inline_run('-v', exes.get('gtest', 'test_gtest'))
+    assert_outcomes(result, [
+        ('FooTest.test_success', 'passed'),
+        ('FooTest.test_failure', 'failed'),
+        ('FooTest.test_error', 'failed'),
+        ('FooTest.DISABLED_test_disabled', 'skipped'),
+    ])
+    assert len(get_gtest_runs(mocked)) == 5
+
+
+def test_google_run_tests_waits_on_error(exes, mocker):
+    """
+    If something fails while running tests in batch, the processes already
+    started are not left behind.
+    """
+    facade = GoogleTestFacade()
+    executable = exes.get('gtest')
+    test_ids = facade.list_tests(executable)
+    processes = []
+    popen = subprocess.Popen
+
+    def popen_spy(*args, **kwargs):
+        processes.append(popen(*args, **kwargs))
+        return processes[-1]
+
+    mocker.patch.object(subprocess, 'Popen', side_effect=popen_spy)
+    mocker.patch.object(GoogleTestFacade, '_parse_xml',
+                        side_effect=RuntimeError('parse error'))
+    with pytest.raises(RuntimeError):
+        facade.run_tests(executable, test_ids, jobs=len(test_ids))
+    assert len(processes) == len(test_ids)
+    assert all(p.returncode is not None for p in processes)
+
+
 def test_unknown_error(testdir, exes, mocker):
     mocker.patch.object(GoogleTestFacade, 'run_test',
                       side_effect=RuntimeError('unknown error'))
@@ -201,6 +493,15 @@ def test_google_internal_errors(mocker, testdir, exes, tmpdir):
 
     assert 'Internal Error: could not find test' in str(rep.longrepr)
 
+    xml_file.write('<testsuites><testsuite name="FooTest">'
+                   '<testcase name="test_other" status="run"/>'
+                   '</testsuite></testsuites>')
+    result = testdir.inline_run('-v', exes.get('gtest', 'test_gtest'))
+    rep = result.matchreport(exes.exe_name('test_gtest'),
+                             'pytest_runtest_logreport')
+    assert 'Internal Error: could not find test' in str(rep.longrepr)
+    assert 'FooTest.test_other' in str(rep.longrepr)
+
 
 def test_boost_run(testdir, exes):
     all_names = ['boost_success', 'boost_error', 'boost_fixture_setup_error', 'boost_failure']